@@ -4,29 +4,49 @@ from datetime import timedelta
 import json
 import logging
 import asyncio
-import aiohttp
 from discord.ext import commands
 from utils.config import cap_channel
-from utils.config import player_url
-from utils.helpers import get_clan_list
-
-async def check_alog(username, search_string):
-    """Returns date if search string is in user history, or if it has previously been recorded."""
-    url = f"{player_url}{username}&activities=20"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as alog_resp:
-            data_json = await alog_resp.json()
-    try:
-        activities = data_json['activities']
-    except KeyError:
-        logging.info(f"{username}'s profile is private.")
+from utils.helpers import get_clan_list, pack_lines
+from utils.profiles import PollSchedule
+
+CAP_INTERVAL = 300
+# Members active within each age are polled every so many seconds, the rest every
+# DORMANT_INTERVAL. No more than POLL_BUDGET members are polled per cap cycle.
+POLL_TIERS = ((timedelta(days=1), 300), (timedelta(days=7), 1800), (timedelta(days=30), 10800))
+DORMANT_INTERVAL = 21600
+POLL_BUDGET = 150
+
+def new_activities(profile, mark, seen):
+    """Returns the (date, activity) pairs not yet processed, newest first, along with how many
+    entries share the newest minute. Returns None if the profile is private."""
+    activities = profile.activities
+    if activities is None:
+        logging.info(f"{profile.username}'s profile is private.")
         return None
+    new = []
+    at_mark = []
     for activity in activities:
+        # Activities are newest first, so an unchanged log stops after a short parse
+        date = datetime.strptime(activity['date'], "%d-%b-%Y %H:%M")
+        if mark is not None and date < mark:
+            break
+        if mark is not None and date == mark:
+            at_mark.append((date, activity))
+        else:
+            new.append((date, activity))
+    # Dates only go down to the minute, so the mark's minute can gain entries after it was
+    # processed. New ones are listed first; the last seen of them were already handled.
+    if new:
+        newest_count = sum(1 for date, _ in new if date == new[0][0])
+    else:
+        newest_count = len(at_mark)
+    return new + at_mark[:max(len(at_mark) - seen, 0)], newest_count
+
+def check_alog(activities, search_string):
+    """Returns date if search string is in the given activities."""
+    for date, activity in activities:
         if search_string in activity['details']:
-            cap_date = activity['date']
-            # logging.info(f"{search_string} found: {username}, {cap_date}")
-            db_date = datetime.strptime(cap_date, "%d-%b-%Y %H:%M")
-            return db_date
+            return date
     return None
 
 async def in_cap_channel(ctx):
@@ -42,8 +62,13 @@ class Cap(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.ledger_seeded = False
+        self.alog_marks = None
+        self.mark_counts = None
+        self.report_lock = asyncio.Lock()
+        self.schedule = PollSchedule(POLL_TIERS, DORMANT_INTERVAL, POLL_BUDGET)
         self.bot.build_tick_checker = self.bot.loop.create_task(self.get_build_tick())
-        self.bot.cap_report = self.bot.loop.create_task(self.report_caps())
+        self.bot.feed.subscribe(self.report_caps, CAP_INTERVAL, self.select_due)
 
     @commands.group(invoke_without_command=True)
     async def cap(self, ctx):
@@ -54,32 +79,22 @@ class Cap(commands.Cog):
     @cap.command()
     @commands.check(in_cap_channel)
     async def list(self, ctx):
-        """Lists the capped users."""
-        def bot_author(message):
-            return message.author.bot
-        def cap_msg(message):
-            return "has capped at the citadel on" in message.content
-        def new_lines(message):
-            return message.content.split("\n")
-        userlist = []
-        async for msg_lines in ctx.channel.history(limit=500).filter(
-                bot_author).filter(cap_msg).map(new_lines):
-            for cap_report in msg_lines:
-                name_index = cap_report.find(" has")
-                userlist.append(cap_report[:name_index])
-        userlist.reverse()
-        ret_str = ""
-        for (pos, val) in enumerate(userlist):
-            if len(ret_str) > 1000:
-                await ctx.send(ret_str)
-                ret_str = ""
-            ret_str += f"{pos+1}. {val}\n"
-        await ctx.send(ret_str)
+        """Lists the users who have capped since the last build tick."""
+        list_stmt = """SELECT rsn FROM caps WHERE last_cap_time >= $1
+            ORDER BY last_cap_time, rsn;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(list_stmt, self.bot.last_build_tick)
+        if not records:
+            await ctx.send("No caps since the last build tick.")
+            return
+        userlist = [f"{pos+1}. {record['rsn']}" for (pos, record) in enumerate(records)]
+        for out_msg in pack_lines(userlist):
+            await ctx.send(out_msg)
 
     @cap.command()
     async def clan(self, ctx):
         """Returns the number of people in the clan."""
-        clan_list = await get_clan_list
+        clan_list = await get_clan_list(self.bot.web)
         await ctx.send(len(clan_list))
 
     @cap.command()
@@ -129,8 +144,15 @@ class Cap(commands.Cog):
 
     @cap.command(name="recheck")
     async def recheck(self, ctx, *user):
-        """Rechecks all alogs for cap messages."""
-        await self.report_caps(list(user))
+        """Rechecks the given alogs (or the whole clan's) once for cap messages."""
+        users = list(user) if user else None
+        try:
+            profiles = await self.bot.feed.poll(users, [self.recheck_caps], fresh=True)
+        except Exception:
+            logging.exception("Recheck failed.")
+            await ctx.send("Recheck failed, see the log for details.")
+            return
+        await ctx.send(f"Rechecked {len(profiles)} alogs.")
 
     @commands.group(invoke_without_command=True)
     async def tick(self, ctx):
@@ -165,67 +187,171 @@ class Cap(commands.Cog):
         await ctx.send(f"Build tick changed.")
         await self.get_build_tick()
 
-    async def get_cap_list(self, clan_list):
-        """Gets the list of all clan members who have capped."""
+    def check_user(self, user, activities):
+        """Checks a single user's alog and returns their cap report, if it is since the tick."""
+        cap_date = check_alog(activities, "capped")
+        # Add the cap only if it exists and it's been since the last build tick.
+        if cap_date is None:
+            return None
+        logging.info(f"Cap date for {user}: {cap_date}")
+        if cap_date < self.bot.last_build_tick:
+            logging.info("Not reporting cap: before build tick.")
+            return None
+        nice_date = datetime.strftime(cap_date, "%d-%b-%Y %H:%M")
+        datetime_list = nice_date.split(" ")
+        cap_str = (f"{user} has capped at the citadel on {datetime_list[0]}"
+                   f" at {datetime_list[1]}.")
+        return (user, cap_date, cap_str)
+
+    def get_new_logs(self, profiles, incremental):
+        """Maps each user to the activities they logged since their high-water mark, and
+        returns the new marks (user, last activity, entries in its minute) to save."""
+        new_logs = {}
+        marks = []
+        for profile in profiles:
+            user = profile.username
+            if incremental:
+                found = new_activities(
+                    profile, self.alog_marks.get(user), self.mark_counts.get(user, 0))
+            else:
+                found = new_activities(profile, None, 0)
+            if found is not None and found[0]:
+                activities, newest_count = found
+                new_logs[user] = activities
+                marks.append((user, activities[0][0], newest_count))
+        logging.info(f"{len(new_logs)} of {len(profiles)} profiles had new activity.")
+        return new_logs, marks
+
+    async def load_alog_marks(self):
+        """Loads every user's last seen activity timestamp."""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(
+                """SELECT rsn, last_activity, mark_count FROM alog_marks;""")
+        self.alog_marks = {record["rsn"]: record["last_activity"] for record in records}
+        self.mark_counts = {record["rsn"]: record["mark_count"] for record in records}
+
+    async def select_due(self, clan_list):
+        """Picks the clan members due for a poll based on their last activity."""
+        if self.alog_marks is None:
+            await self.load_alog_marks()
+        return self.schedule.due(clan_list, self.alog_marks)
+
+    async def save_alog_marks(self, marks):
+        """Advances the high-water marks of every user with new activity."""
+        if not marks:
+            return
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                mark_stmt = """INSERT INTO alog_marks(rsn, last_activity, mark_count)
+                    VALUES($1, $2, $3)
+                    ON CONFLICT (rsn) DO UPDATE SET last_activity = EXCLUDED.last_activity,
+                    mark_count = EXCLUDED.mark_count
+                    WHERE (alog_marks.last_activity, alog_marks.mark_count)
+                    < (EXCLUDED.last_activity, EXCLUDED.mark_count);"""
+                await con.executemany(mark_stmt, marks)
+        for user, last_activity, mark_count in marks:
+            if (user not in self.alog_marks or (self.alog_marks[user], self.mark_counts[user])
+                    < (last_activity, mark_count)):
+                self.alog_marks[user] = last_activity
+                self.mark_counts[user] = mark_count
+
+    async def get_cap_list(self, new_logs):
+        """Gets the list of all clan members who have capped and not yet been announced."""
+        candidates = [self.check_user(user, activities) for user, activities in new_logs.items()]
+        candidates = [report for report in candidates if report is not None]
+        if not candidates:
+            return []
+        reported_stmt = """SELECT rsn, cap_time FROM cap_reports
+            WHERE (rsn, cap_time) IN (SELECT * FROM unnest($1::text[], $2::timestamp[]));"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(
+                reported_stmt, [rep[0] for rep in candidates], [rep[1] for rep in candidates])
+        reported = {(record["rsn"], record["cap_time"]) for record in records}
         cap_list = []
-        for user in clan_list:
-            cap_date = await check_alog(user, "capped")
-            # Add the cap only if it exists, it's been since the last build tick, and
-            # there's no message already in the channel.
-            if cap_date is not None:
-                logging.info(f"Cap date for {user}: {cap_date}")
-                if cap_date < self.bot.last_build_tick:
-                    logging.info("Not reporting cap: before build tick.")
-                else:
-                    nice_date = datetime.strftime(cap_date, "%d-%b-%Y %H:%M")
-                    datetime_list = nice_date.split(" ")
-                    cap_str = (f"{user} has capped at the citadel on {datetime_list[0]}"
-                               f" at {datetime_list[1]}.")
-                    cap_msg_list = await self.bot.cap_ch.history().filter(
-                        lambda m: m.author == self.bot.user).map(lambda m: m.content).filter(
-                            lambda m, c_s=cap_str: c_s in m).flatten()
-                    if cap_msg_list:
-                        logging.info("Not reporting cap: cap message exists.")
-                    if not cap_msg_list:
-                        cap_list.append((user, cap_date, cap_str))
+        for user, cap_date, cap_str in candidates:
+            if (user, cap_date) in reported:
+                logging.info(f"Not reporting cap for {user}: cap already announced.")
+            else:
+                cap_list.append((user, cap_date, cap_str))
         logging.info(cap_list)
         return cap_list
 
-    async def report_caps(self, user=()):
-        """Reports caps."""
-        await self.bot.wait_until_ready()
-        self.bot.cap_ch = self.bot.get_channel(cap_channel)
-        while not self.bot.is_closed():
-            logging.info(f"Last build tick: {self.bot.last_build_tick}")
-            if not user:
-                clan_list = await get_clan_list()
-            else:
-                clan_list = user
-            # Make sure all names are in the database prior to adding new cap records
-            await self.update_names(clan_list)
-            cap_list = await self.get_cap_list(clan_list)
-
-            for name, cap_date, cap_str in cap_list:
-                # Send messages to channel reporting the caps
-                await self.bot.cap_ch.send(cap_str)
-
-                # Put caps in database - update records to most recent time
-                async with self.bot.pool.acquire() as con:
-                    async with con.transaction():
-                        upsert_stmt = f"""INSERT INTO caps(rsn, last_cap_time)
-                            VALUES($1, $2) ON CONFLICT ON CONSTRAINT caps_rsn_key 
-                            DO UPDATE SET last_cap_time = EXCLUDED.last_cap_time;
-                            """
-                        await con.execute(upsert_stmt, name, cap_date)
-            await asyncio.sleep(600)
-
-    async def update_names(self, clan_list):
-        """Adds all names from the clan list to the database."""
+    async def seed_cap_ledger(self):
+        """Fills an empty cap ledger from the cap messages sent since the last build tick."""
+        async with self.bot.pool.acquire() as con:
+            has_reports = await con.fetchval("""SELECT EXISTS(SELECT 1 FROM cap_reports);""")
+        if has_reports:
+            return
+        reports = []
+        async for msg in self.bot.cap_ch.history(limit=None, after=self.bot.last_build_tick):
+            if msg.author != self.bot.user:
+                continue
+            for cap_report in msg.content.split("\n"):
+                name_index = cap_report.find(" has capped at the citadel on ")
+                if name_index == -1:
+                    continue
+                words = cap_report.split(" ")
+                cap_date = datetime.strptime(
+                    f"{words[-3]} {words[-1].rstrip('.')}", "%d-%b-%Y %H:%M")
+                reports.append((cap_report[:name_index], cap_date, msg.created_at))
         async with self.bot.pool.acquire() as con:
             async with con.transaction():
-                upsert_stmt = """INSERT INTO rs(rsn) VALUES($1) ON CONFLICT (rsn) DO NOTHING;"""
-                names = [(name,) for name in clan_list]
-                await con.executemany(upsert_stmt, names)
+                await con.executemany(
+                    """INSERT INTO rs(rsn) VALUES($1) ON CONFLICT (rsn) DO NOTHING;""",
+                    [(rep[0],) for rep in reports])
+                await con.executemany(
+                    """INSERT INTO cap_reports(rsn, cap_time, reported_dtg) VALUES($1, $2, $3)
+                    ON CONFLICT DO NOTHING;""", reports)
+        logging.info(f"Seeded cap ledger with {len(reports)} announced caps.")
+
+    async def recheck_caps(self, profiles):
+        """Reports caps found anywhere in the given profiles' logs, ignoring high-water marks."""
+        await self.report_caps(profiles, incremental=False)
+
+    async def report_caps(self, profiles, incremental=True):
+        """Reports caps found in the given profiles."""
+        # Only members whose profiles actually arrived count as polled; failed downloads
+        # stay due and are retried on the next cycle.
+        self.schedule.mark_polled([profile.username for profile in profiles])
+        # Rechecks and the polling loop share the ledger, so only one may report at a time
+        async with self.report_lock:
+            await self.report_new_caps(profiles, incremental)
+
+    async def report_new_caps(self, profiles, incremental):
+        """Announces and records the caps in the given profiles that aren't in the ledger."""
+        self.bot.cap_ch = self.bot.get_channel(cap_channel)
+        logging.info(f"Last build tick: {self.bot.last_build_tick}")
+        if not self.ledger_seeded:
+            await self.seed_cap_ledger()
+            self.ledger_seeded = True
+        if self.alog_marks is None:
+            await self.load_alog_marks()
+        new_logs, marks = self.get_new_logs(profiles, incremental)
+        cap_list = await self.get_cap_list(new_logs)
+
+        # Send messages to channel reporting the caps, as few as will fit
+        for cap_msg in pack_lines([cap_str for _, _, cap_str in cap_list]):
+            await self.bot.cap_ch.send(cap_msg)
+
+        # Put caps in database - update records to most recent time, and
+        # record the announcements in the ledger
+        if cap_list:
+            names = [name for name, _, _ in cap_list]
+            cap_dates = [cap_date for _, cap_date, _ in cap_list]
+            async with self.bot.pool.acquire() as con:
+                async with con.transaction():
+                    upsert_stmt = """INSERT INTO caps(rsn, last_cap_time)
+                        SELECT * FROM unnest($1::text[], $2::timestamp[])
+                        ON CONFLICT ON CONSTRAINT caps_rsn_key
+                        DO UPDATE SET last_cap_time = EXCLUDED.last_cap_time;
+                        """
+                    await con.execute(upsert_stmt, names, cap_dates)
+                    ledger_stmt = """INSERT INTO cap_reports(rsn, cap_time, reported_dtg)
+                        SELECT rsn, cap_time, $3 FROM unnest($1::text[], $2::timestamp[])
+                        AS reported(rsn, cap_time) ON CONFLICT DO NOTHING;"""
+                    await con.execute(ledger_stmt, names, cap_dates, datetime.utcnow())
+        # Only advance the marks once every cap they cover has been announced
+        await self.save_alog_marks(marks)
 
     async def get_build_tick(self):
         """Returns the most recent build tick"""
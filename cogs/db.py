@@ -2,7 +2,12 @@
 from datetime import datetime
 from discord.ext import commands
 from utils.config import registration_channel
-from cogs.xp import rsn_exists
+
+async def rsn_exists(con, rsn):
+    """Checks if a given rsn is present in the database (clan members only)."""
+    rsn_stmt = """SELECT EXISTS(SELECT 1 FROM rs WHERE rsn = $1)"""
+    exists = await con.fetchval(rsn_stmt, rsn)
+    return exists
 
 class Database(commands.Cog):
     """Defines database commands."""
@@ -80,6 +85,12 @@ class Database(commands.Cog):
 
         await self.handle_approval(ctx, msg_dct, rsn_dct)
 
+    def forget_main_rsns(self):
+        """Tells the xp cog that a member's main rsn may have changed."""
+        xp_cog = self.bot.get_cog("XP")
+        if xp_cog is not None:
+            xp_cog.forget_main_rsns()
+
     async def register_user(self, rsn_dct):
         """Inserts account registers into the database."""
         rsn = rsn_dct["new_rsn"]
@@ -97,6 +108,7 @@ class Database(commands.Cog):
                      VALUES ($1, $2, $3, $4);"""
                 start_dtg = datetime.now()
                 await con.execute(account_stmt, disc_id, rsn, is_main, start_dtg)
+        self.forget_main_rsns()
 
     async def handle_change(self, ctx, old_rsn, new_rsn, is_main):
         """Handles name changes."""
@@ -156,6 +168,7 @@ class Database(commands.Cog):
                      VALUES ($1, $2, $3, $4);"""
                 start_dtg = datetime.now()
                 await con.execute(account_stmt, disc_id, new_rsn, is_main, new_start_dtg)
+        self.forget_main_rsns()
 
     @commands.group()
     async def register(self, ctx):
@@ -2,26 +2,21 @@
 import time
 import random
 import datetime
-import aiohttp
 import discord
 from discord.ext import commands
-from utils.config import player_url
 
-async def get_alog(username):
+def get_alog(profile):
     """Returns a nicely formatted string containing data from the users' adventurer's log."""
-    url = f"{player_url}{username}&activities=20"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as alog_resp:
-            data_json = await alog_resp.json()
-    try:
+    username = profile.username
+    activities = profile.activities
+    if activities is None:
+        out_msg = f"{username}'s profile is private."
+    else:
         out_msg = f"Adventurer's Log for {username}:\n"
-        activities = data_json["activities"]
         for activity in activities:
             date = activity['date']
             text = activity['text']
             out_msg += f"Date: {date}      Log Entry: {text}\n"
-    except KeyError:
-        out_msg = f"{username}'s profile is private."
     out_msg = f"```{out_msg}```"
     return out_msg
 
@@ -92,7 +87,8 @@ class RS(commands.Cog):
     async def alog(self, ctx, *, user):
         """Returns information from the user's adventurer's log."""
         " ".join(user)
-        await ctx.send(get_alog(user))
+        profile = await self.bot.feed.fetch_profile(user)
+        await ctx.send(get_alog(profile))
 
     @commands.command(aliases=['rax', 'spooder', 'araxxor'])
     async def araxxi(self, ctx):
@@ -1,135 +1,275 @@
 """Defines the functions used for gathering and reporting xp."""
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
+from typing import Optional
 import asyncio
-import json
+import io
 import logging
-import aiohttp
+import math
+import re
+import asyncpg
 import discord
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 from discord.ext import commands
-from utils.config import player_url
-from utils.helpers import get_clan_list, update_names
+from utils.charts import ChartCache, ChartRenderer, RenderQueueFull
+from utils.charts import CHART_CACHE_BYTES, HISTORY_BUCKETS, HISTORY_POINTS, lttb
+from utils.charts import render_comparison
+from utils.charts import render_history
+from utils.dbs import maintain_history
+from utils.helpers import MAX_MESSAGE_LENGTH, pack_lines, update_names
+from utils.levels import LevelTable
+from utils.skills import get_skill_index
 
-def get_skill_dict():
-    """Returns the dictionary containing all skills and ids."""
-    with open(f"./resources/skills.json", "r+") as skills_file:
-        skill_names = json.load(skills_file)
-    return skill_names
+SWEEP_TICK = 300
+SWEEP_WINDOW = timedelta(hours=20)
+SWEEP_CATCHUP = 3
+RETENTION_INTERVAL = 86400
+TOP_DEFAULT = 10
+LEADERBOARD_MAX_AGE = timedelta(days=2)
+SINCE_OPTION = re.compile(r"(?:--since\s+(\d+)([dwmy]))?")
+SINCE_UNITS = {"d": 1, "w": 7, "m": 30, "y": 365}
+PERIOD = re.compile(r"(\d+)([dwmy])")
+PERIOD_NAMES = {"today": "1d", "day": "1d", "week": "1w", "month": "1m", "year": "1y"}
 
 def get_skill_info(argument):
-    """Converts a skill name to a dictionary containing the full skill name and id."""
-    skill_names = get_skill_dict()
-    skills = {**skill_names["nicknames"], **skill_names["fullnames"]}
-    skill_info = skills.get(argument, None)
+    """Converts a skill name, nickname, prefix or near miss to a dictionary containing the full
+    skill name and id."""
     if argument == "all":
-        skill_info = "all"
-    return skill_info
-
-async def rsn_from_id(con, disc_id):
-    """Retrieves the most current main rsn given a player's discord id.
-    Returns None is player is not registered with an rsn."""
-    rsn_stmt = """SELECT rsn FROM account_owned WHERE disc_id = $1 AND is_main = True
-            AND end_dtg IS NULL ORDER BY end_dtg DESC LIMIT 1;
-            """
-    rsn = await con.fetchval(rsn_stmt, str(disc_id))
-    logging.info(rsn)
-    return rsn
-
-async def rsn_exists(con, rsn):
-    """Checks if a given rsn is present in the database (clan members only)."""
-    rsn_stmt = """SELECT EXISTS(SELECT 1 FROM rs WHERE rsn = $1)"""
-    exists = await con.fetchval(rsn_stmt, rsn)
-    return exists
+        return "all"
+    return get_skill_index().lookup(argument)
+
+def get_period(argument):
+    """Converts a period such as 'week' or '30d' into a number of days."""
+    match = PERIOD.fullmatch(PERIOD_NAMES.get(argument.lower(), argument.lower()))
+    if match is None or int(match.group(1)) == 0:
+        raise commands.BadArgument(f"{argument} is not a period.")
+    return int(match.group(1))*SINCE_UNITS[match.group(2)]
+
+def period_start(days):
+    """Returns the first day of a period of the given number of days ending today."""
+    return date.today() - timedelta(days=days - 1)
+
+# Resolves the requested players in SQL: $1 holds the names as typed, $2 the Discord ids of
+# mentioned members and $3 the rsns typed directly. Members map to their current main rsn.
+REQUESTED_PLAYERS = """WITH requested AS (
+        SELECT req.name, req.pos, COALESCE(owned.rsn, rs.rsn) AS rsn
+        FROM unnest($1::text[], $2::text[], $3::text[]) WITH ORDINALITY
+            AS req(name, disc_id, rsn, pos)
+        LEFT JOIN LATERAL (
+            SELECT rsn FROM account_owned WHERE disc_id = req.disc_id AND is_main = True
+            AND end_dtg IS NULL LIMIT 1) AS owned ON True
+        LEFT JOIN rs ON rs.rsn = req.rsn)"""
 
 class Player(commands.Cog):
     """Defines the Player class, used to capture either a Discord user or rsn."""
-    def __init__(self, rsn):
+    def __init__(self, name, disc_id=None, rsn=None):
+        self.name = name
+        self.disc_id = disc_id
         self.rsn = rsn
 
     @classmethod
     async def convert(cls, ctx, player):
-        """Converts a Discord user to a valid rsn, or confirms an rsn."""
+        """Converts a Discord user or an rsn into a player, resolved later in one query."""
+        if player.startswith("--"):
+            raise commands.BadArgument(f"{player} is an option, not a player.")
         try:
             member = await commands.MemberConverter().convert(ctx, player)
             logging.info(f"Member: {member}")
-            async with ctx.bot.pool.acquire() as con:
-                rsn = await rsn_from_id(con, member.id)
-            if rsn is None:
-                await ctx.send(f"Error: Player {player} not found in database.")
-            return cls(rsn)
+            return cls(player, disc_id=str(member.id))
         except commands.BadArgument:
-            async with ctx.bot.pool.acquire() as con:
-                exists = await rsn_exists(con, player)
-            if not exists:
-                await ctx.send(f"Error: Player {player} not found in database.")
-            return cls(player)
+            return cls(player, rsn=player)
+
+class NoticeRecorder:
+    """Stands in for a command context while charts are drawn, keeping the notices sent."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.notices = []
+
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+
+    async def send(self, content):
+        """Sends a notice to the real context and keeps a copy."""
+        self.notices.append(content)
+        return await self.ctx.send(content)
 
 class XP(commands.Cog):
     """Defines the cap command and functions."""
 
     def __init__(self, bot):
         self.bot = bot
-        self.bot.xp_report = self.bot.loop.create_task(self.report_xp())
+        self.levels = None
+        self.renderer = ChartRenderer()
+        self.charts = ChartCache(CHART_CACHE_BYTES)
+        self.change_times = None
+        self.main_rsns = None
+        self.sweep_finishing = False
+        self.leaderboards = None
+        self.report_lock = asyncio.Lock()
+        self.bot.feed.subscribe(self.report_xp, SWEEP_TICK, self.select_sweep)
+        self.retention_task = self.bot.loop.create_task(self.run_retention())
 
-    async def get_players(self, ctx, players):
-        """Converts list of players into a readable list, includes author."""
+    def cog_unload(self):
+        """Stops the chart workers and the retention job when the cog is unloaded."""
+        self.renderer.close()
+        self.retention_task.cancel()
+
+    async def run_retention(self):
+        """Adds upcoming history partitions and compacts old ones once a day."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            try:
+                async with self.bot.pool.acquire() as con:
+                    compacted = await maintain_history(con)
+                logging.info(f"History retention compacted {compacted} partitions.")
+            except Exception:
+                logging.exception("History retention failed.")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def player_args(self, ctx, players):
+        """Returns the query arguments for REQUESTED_PLAYERS, defaulting to the author."""
         if not players:
-            auth = await Player.convert(ctx, ctx.author.name)
-            players = [auth]
-        players = [player.rsn for player in players if player is not None]
-        logging.info(f"Players requested: {players}")
-        return players
+            players = [Player(ctx.author.name, disc_id=str(ctx.author.id))]
+        players = list({player.name: player for player in players}.values())
+        logging.info(f"Players requested: {[player.name for player in players]}")
+        return ([player.name for player in players], [player.disc_id for player in players],
+                [player.rsn for player in players])
+
+    async def report_missing(self, ctx, names):
+        """Tells the user which of the requested players have no records."""
+        if names:
+            await ctx.send(f"Not found in database: {', '.join(names)}.")
+
+    async def get_players(self, ctx, players):
+        """Converts list of players into a list of registered rsns, defaulting to the author."""
+        players_stmt = f"""{REQUESTED_PLAYERS}
+            SELECT name, rsn FROM requested ORDER BY pos;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(players_stmt, *self.player_args(ctx, players))
+        await self.report_missing(ctx, [rec["name"] for rec in records if rec["rsn"] is None])
+        return [rec["rsn"] for rec in records if rec["rsn"] is not None]
 
     async def get_xp_list(self, ctx, info, players):
-        """Gets the skill info for each player, returns a list sorted by xp value."""
-        # We have the skill ID and member, so we need to pull the most recent XP record for the
-        # given user(s). If no user(s) are supplied, default to the registered rsn of the
+        """Gets the skill info for each player, returns a list sorted by rank."""
+        # We have the skill ID and members, so we need to pull the most recent XP record for
+        # the given user(s). If no user(s) are supplied, default to the registered rsn of the
         # Discord member who sent the command.
-        players = await self.get_players(ctx, players)
-        skill_id = info["id"]
-        xp_list = []
-        # Now that we have a tuple of the valid players from the command, we can retrieve xp
-        # and skill values for each player in the specified skill.
+        skill_id = int(info["id"])
+        xp_stmt = f"""{REQUESTED_PLAYERS}
+            SELECT requested.name, requested.rsn, level, xp, rank FROM requested
+            LEFT JOIN latest_xp ON latest_xp.rsn = requested.rsn AND skill_id = $4
+            ORDER BY rank NULLS LAST, pos;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(xp_stmt, *self.player_args(ctx, players), skill_id)
+        await self.report_missing(ctx, [rec["name"] for rec in records if rec["xp"] is None])
+        return [[rec["rsn"], rec["level"], rec["xp"], rec["rank"]]
+                for rec in records if rec["xp"] is not None]
+
+    async def draw_chart(self, ctx, func, *args):
+        """Renders a chart off the event loop, returning its PNG bytes or None on failure."""
+        try:
+            return await self.renderer.render(func, *args)
+        except RenderQueueFull:
+            await ctx.send("Too many charts are being drawn right now, try again shortly.")
+        except asyncio.TimeoutError:
+            await ctx.send("Drawing that chart took too long.")
+        return None
+
+    def forget_main_rsns(self):
+        """Drops the cached map of Discord ids to main rsns, after registrations or name
+        changes."""
+        self.main_rsns = None
+
+    async def load_chart_maps(self):
+        """Loads whichever of the main rsn and xp change time maps aren't cached yet."""
+        async with self.bot.pool.acquire() as con:
+            if self.main_rsns is None:
+                mains_stmt = """SELECT disc_id, rsn FROM account_owned
+                    WHERE is_main = True AND end_dtg IS NULL;"""
+                self.main_rsns = {rec["disc_id"]: rec["rsn"]
+                                  for rec in await con.fetch(mains_stmt)}
+            if self.change_times is None:
+                times_stmt = """SELECT rsn, max(dtg) AS dtg FROM latest_xp GROUP BY rsn;"""
+                self.change_times = {rec["rsn"]: rec["dtg"]
+                                     for rec in await con.fetch(times_stmt)}
+
+    async def chart_key(self, ctx, command, info, players, *options):
+        """Identifies a chart by command, skill, options and the requested players, each with
+        the time their xp last changed. Charts end today, so the day is part of the key too.
+        Only in-memory maps are read, so cached charts are served without touching Postgres."""
+        if self.main_rsns is None or self.change_times is None:
+            await self.load_chart_maps()
+        if not players:
+            players = [Player(ctx.author.name, disc_id=str(ctx.author.id))]
+        requested = set()
         for player in players:
-            async with self.bot.pool.acquire() as con:
-                xp_stmt = """SELECT (skills -> $1 ->> 'level')::integer AS level,
-                            (skills -> $1 ->> 'xp')::decimal AS xp,
-                            (skills -> $1 ->> 'rank')::integer AS rank
-                            FROM xp WHERE rsn = $2 ORDER BY dtg DESC LIMIT 1;"""
-                xp_res = await con.fetchrow(xp_stmt, skill_id, player)
-                if xp_res is None:
-                    await ctx.send(f"Player {player} not found in database.")
-                else:
-                    xp_list.append([player, xp_res["level"], xp_res["xp"], xp_res["rank"]])
+            if player.disc_id is not None:
+                rsn = self.main_rsns.get(player.disc_id, None)
+            else:
+                rsn = player.rsn
+            requested.add((player.disc_id or player.rsn, rsn, self.change_times.get(rsn, None)))
+        return (command, int(info["id"]), tuple(sorted(requested, key=repr)), options,
+                date.today())
 
-        xp_list = sorted(xp_list, key=lambda x: x[3])
-        return xp_list
+    async def send_charts(self, ctx, key, draw):
+        """Sends the charts cached under key, drawing and caching them first if needed.
+        Notices sent while drawing, such as missing players, are cached and replayed too."""
+        replies = self.charts.get(key)
+        if replies is not None:
+            for reply in replies:
+                if isinstance(reply, bytes):
+                    await ctx.send(file=discord.File(io.BytesIO(reply), filename="hist.png"))
+                else:
+                    await ctx.send(reply)
+            return
+        recorder = NoticeRecorder(ctx)
+        pngs = await draw(recorder)
+        # Charts that failed to draw aren't cached, so the next request tries again
+        if None not in pngs:
+            self.charts.put(key, recorder.notices + pngs)
+        for png in pngs:
+            if png is not None:
+                await ctx.send(file=discord.File(io.BytesIO(png), filename="hist.png"))
 
-    async def get_xp_history(self, ctx, info, players):
-        """Gets historical xp info for each player."""
+    async def get_xp_history(self, ctx, info, players, since=None):
+        """Gets historical xp info for each player, returning a chart for each.
+        Snapshots are bucketed in SQL by the finest of day, week or month that keeps the range
+        within HISTORY_BUCKETS buckets, then downsampled to at most HISTORY_POINTS points."""
         players = await self.get_players(ctx, players)
-        skill_id = info["id"]
+        skill_id = int(info["id"])
         skill = info["skill"]
-        plt.clf()
+        # Unchanged skills aren't stored, so each bucket takes the last value recorded at
+        # or before its end, carrying values forward through the gaps.
+        xp_stmt = """WITH span AS (
+                SELECT start_dtg, CASE
+                    WHEN $4::timestamp - start_dtg <= interval '1 day'*$5::integer THEN 'day'
+                    WHEN $4::timestamp - start_dtg <= interval '1 week'*$5::integer THEN 'week'
+                    ELSE 'month' END AS unit
+                FROM (SELECT COALESCE($3::timestamp, min(dtg)) AS start_dtg FROM xp
+                    WHERE skill_id = $1 AND rsn = $2) AS bounds
+                WHERE start_dtg IS NOT NULL)
+            SELECT bucket, last_xp.xp FROM span,
+                generate_series(date_trunc(span.unit, span.start_dtg),
+                    date_trunc(span.unit, $4::timestamp), ('1 ' || span.unit)::interval)
+                    AS bucket,
+                LATERAL (SELECT xp FROM xp WHERE skill_id = $1 AND rsn = $2
+                    AND dtg < bucket + ('1 ' || span.unit)::interval
+                    ORDER BY dtg DESC LIMIT 1) AS last_xp
+            ORDER BY bucket;"""
+        pngs = []
         for player in players:
-            player_dict = {}
             async with self.bot.pool.acquire() as con:
-                async with con.transaction():
-                    xp_stmt = """SELECT (skills -> $1 ->> 'xp')::float AS xp, dtg
-                                FROM xp WHERE rsn = $2 ORDER BY dtg DESC;"""
-                    async for record in con.cursor(xp_stmt, skill_id, player):
-                        player_dict[record["dtg"]] = record["xp"]
-            player_series = pd.Series(player_dict)
-            player_series.plot()
-            plt.xlabel("Date")
-            plt.ylabel(f"XP Amount")
-            plt.title(f"{player}'s {skill.title()} XP Gains")
-            plt.tight_layout()
-            plt.savefig('./figures/hist.png')
-            with open('./figures/hist.png', 'rb') as histogram:
-                await ctx.send(file=discord.File(histogram))
+                records = await con.fetch(xp_stmt, skill_id, player, since, datetime.now(),
+                                          HISTORY_BUCKETS)
+            if not records:
+                await ctx.send(f"No {skill} history for {player} in that range.")
+                continue
+            dates = [record["bucket"] for record in records]
+            values = [record["xp"] for record in records]
+            keep = lttb([date.timestamp() for date in dates], values, HISTORY_POINTS)
+            dates = [dates[index] for index in keep]
+            values = [values[index] for index in keep]
+            pngs.append(await self.draw_chart(ctx, render_history, skill, player, dates, values))
+        return pngs
 
     @commands.group(invoke_without_command=True)
     async def xp(self, ctx, info: get_skill_info, players: commands.Greedy[Player] = None):
@@ -149,9 +289,8 @@ class XP(commands.Cog):
     @xp.command(name="list")
     async def list(self, ctx):
         """Sends a direct message containing skill nicknames."""
-        skill_names = get_skill_dict()
         out_msg = "List of skills and their aliases:\n```"
-        nicknames = skill_names["nicknames"]
+        nicknames = get_skill_index().nicknames
         for nickname, skill_info in nicknames.items():
             out_msg += f"{skill_info['skill']}: {nickname}\n"
         out_msg = out_msg[:-1] + "```"
@@ -160,44 +299,106 @@ class XP(commands.Cog):
     @xp.command(name="graph")
     async def graph(self, ctx, info: get_skill_info, players: commands.Greedy[Player] = None):
         """Plots line graph of requested skill for requested players."""
-        xp_list = await self.get_xp_list(ctx, info, players)
-        skill = info["skill"]
-        plt.clf()
-        players = [rec[0] for rec in xp_list]
-        values = [rec[2] for rec in xp_list]
-        fig, axes = plt.subplots(figsize=(16, 6))
-        axes.set_facecolor("#F3F3F3")
-        index = np.arange(len(players))
-        plt.bar(index, values, alpha=0.4, color="gold", edgecolor="black", align='center')
-        plt.xlabel("Players")
-        plt.ylabel(f"XP Amount")
-        plt.title(f"Clan {skill.title()} XP Comparison")
-        plt.xticks(index, players)
-        fig.autofmt_xdate()
-        plt.tight_layout()
-        plt.savefig('./figures/hist.png')
-        with open('./figures/hist.png', 'rb') as histogram:
-            await ctx.send(file=discord.File(histogram))
+        if info is None:
+            await ctx.send("Please enter a valid skill name.")
+            return
+        async def draw(ctx):
+            xp_list = await self.get_xp_list(ctx, info, players)
+            if not xp_list:
+                return []
+            skill = info["skill"]
+            names = [rec[0] for rec in xp_list]
+            values = [rec[2] for rec in xp_list]
+            return [await self.draw_chart(ctx, render_comparison, skill, names, values)]
+        key = await self.chart_key(ctx, "graph", info, players)
+        await self.send_charts(ctx, key, draw)
+
+    async def get_gains(self, ctx, info, players, days):
+        """Gets each player's xp gained in a skill over the last days, sorted by gain."""
+        gains_stmt = f"""{REQUESTED_PLAYERS}
+            SELECT requested.name, requested.rsn, COALESCE(sum(xp_gained), 0) AS gained
+            FROM requested
+            LEFT JOIN xp_gains ON xp_gains.rsn = requested.rsn AND skill_id = $4 AND day >= $5
+            GROUP BY requested.name, requested.rsn, pos
+            ORDER BY gained DESC, pos;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(gains_stmt, *self.player_args(ctx, players),
+                                      int(info["id"]), period_start(days))
+        await self.report_missing(ctx, [rec["name"] for rec in records if rec["rsn"] is None])
+        return [(rec["rsn"], rec["gained"]) for rec in records if rec["rsn"] is not None]
 
     @xp.command(name="gains")
-    async def gains(self, ctx, info: get_skill_info, players: commands.Greedy[Player] = None):
-        """Plots gains of requested skill for requested players."""
-        await self.get_xp_history(ctx, info, players)
+    async def gains(self, ctx, info: get_skill_info, period: Optional[get_period] = None,
+                    players: commands.Greedy[Player] = None, *, options=""):
+        """Plots gains of requested skill for requested players.
+        Add '--since <n><d|w|m|y>' to only plot recent gains, e.g. '--since 30d'.
+        Give a period instead, e.g. 'week' or '30d', to list the xp gained over it."""
+        if info is None:
+            await ctx.send("Please enter a valid skill name.")
+            return
+        if period is not None:
+            gains = await self.get_gains(ctx, info, players, period)
+            if not gains:
+                return
+            out_msg = f"{info['skill'].title()} xp gained in the last {period} days:\n"
+            for rsn, gained in gains:
+                out_msg += f"{rsn}: {gained:,.0f} xp\n"
+            await ctx.send(f"```{out_msg[:-1]}```")
+            return
+        match = SINCE_OPTION.fullmatch(options.strip())
+        if options.strip() and match is None:
+            await ctx.send("Usage: $xp gains <skill> [period] [players] [--since <n><d|w|m|y>]")
+            return
+        since = None
+        if match is not None and match.group(1) is not None:
+            days = int(match.group(1))*SINCE_UNITS[match.group(2)]
+            since = datetime.now() - timedelta(days=days)
+        key = await self.chart_key(ctx, "gains", info, players, options.strip())
+        await self.send_charts(ctx, key, lambda ctx: self.get_xp_history(ctx, info, players, since))
+
+    @xp.command(name="gainers")
+    async def gainers(self, ctx, info: get_skill_info, period: get_period = 7,
+                      count: int = TOP_DEFAULT):
+        """Ranks the clan by xp gained in a skill over a period, e.g. 'week' or '30d'."""
+        if info is None:
+            await ctx.send("Please enter a valid skill name.")
+            return
+        gainers_stmt = """SELECT rsn, gained, rank() OVER (ORDER BY gained DESC) AS gain_rank,
+                gained/sum(gained) OVER () AS share
+            FROM (SELECT rsn, sum(xp_gained) AS gained FROM xp_gains
+                WHERE skill_id = $1 AND day >= $2 GROUP BY rsn) AS totals
+            ORDER BY gain_rank, rsn LIMIT $3;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(gainers_stmt, int(info["id"]), period_start(period),
+                                      max(count, 1))
+        if not records:
+            await ctx.send(f"No {info['skill']} gains recorded in the last {period} days.")
+            return
+        lines = [f"Clan {info['skill'].title()} Gains, last {period} days:"]
+        for rec in records:
+            lines.append(f"{rec['gain_rank']}. {rec['rsn']}: {rec['gained']:,.0f} xp "
+                         f"({rec['share']*100:.1f}% of clan)")
+        for out_msg in pack_lines(lines, MAX_MESSAGE_LENGTH - 6):
+            await ctx.send(f"```{out_msg}```")
+
+    async def get_latest_comp(self, ctx, players, column):
+        """Gets each player's most recent value of a comp column, sorted by that value."""
+        comp_stmt = f"""{REQUESTED_PLAYERS}
+            SELECT requested.name, requested.rsn, {column} AS pct FROM requested
+            LEFT JOIN latest_comp ON latest_comp.rsn = requested.rsn
+            ORDER BY {column} NULLS LAST, pos;"""
+        async with self.bot.pool.acquire() as con:
+            records = await con.fetch(comp_stmt, *self.player_args(ctx, players))
+        await self.report_missing(ctx, [rec["name"] for rec in records if rec["pct"] is None])
+        return [(rec["rsn"], rec["pct"]) for rec in records if rec["pct"] is not None]
 
     @commands.group(name="max", invoke_without_command=True)
     async def max(self, ctx, players: commands.Greedy[Player] = None):
         """Returns max percentage/details for requested players."""
         if ctx.invoked_subcommand is None:
-            players = await self.get_players(ctx, players)
-            if players is None:
+            max_pct_output = await self.get_latest_comp(ctx, players, "max_pct")
+            if not max_pct_output:
                 return
-            output = []
-            for player in players:
-                async with self.bot.pool.acquire() as con:
-                    max_pct_stmt = '''SELECT max_pct FROM comp WHERE rsn = $1 ORDER BY dtg DESC LIMIT 1;'''
-                    max_pct = await con.fetchval(max_pct_stmt, player)
-                output.append((player, max_pct))
-            max_pct_output = sorted(output, key=lambda x: x[1])
             out_msg = "Percent to Max:\n"
             for rsn, max_pct in max_pct_output:
                 out_msg += f"{rsn}: {round(max_pct*100,2)}%\n"
@@ -207,110 +408,244 @@ class XP(commands.Cog):
     async def comp(self, ctx, players: commands.Greedy[Player] = None):
         """Returns comp percentage/details for requested players."""
         if ctx.invoked_subcommand is None:
-            players = await self.get_players(ctx, players)
-            output = []
-            for player in players:
-                async with self.bot.pool.acquire() as con:
-                    comp_pct_stmt = '''SELECT comp_pct FROM comp WHERE rsn = $1 ORDER BY dtg DESC LIMIT 1;'''
-                    comp_pct = await con.fetchval(comp_pct_stmt, player)
-                output.append((player, comp_pct))
-            comp_pct_output = sorted(output, key=lambda x: x[1])
+            comp_pct_output = await self.get_latest_comp(ctx, players, "comp_pct")
+            if not comp_pct_output:
+                return
             out_msg = "Percent to Comp:\n"
             for rsn, comp_pct in comp_pct_output:
                 out_msg += f"{rsn}: {round(comp_pct*100,2)}%\n"
             await ctx.send(f"```{out_msg[:-1]}```")
 
+    async def update_leaderboards(self):
+        """Ranks recently snapshotted members in every skill, with their daily and weekly gains,
+        replacing the stored leaderboards."""
+        # Members whose latest snapshot is older than LEADERBOARD_MAX_AGE have left the clan or
+        # gone private, so they drop off the board. Gains come from the daily rollup.
+        leaderboard_stmt = """INSERT INTO leaderboard(skill_id, rsn, clan_rank, level, xp,
+                daily_gain, weekly_gain)
+            SELECT cur.skill_id, cur.rsn,
+                rank() OVER (PARTITION BY cur.skill_id ORDER BY cur.xp DESC NULLS LAST),
+                cur.level, cur.xp, COALESCE(gains.daily, 0), COALESCE(gains.weekly, 0)
+            FROM latest_xp AS cur
+            LEFT JOIN (SELECT rsn, skill_id, sum(xp_gained) FILTER (WHERE day = $1) AS daily,
+                    sum(xp_gained) AS weekly
+                FROM xp_gains WHERE day >= $1::date - 6 GROUP BY rsn, skill_id) AS gains
+                ON gains.rsn = cur.rsn AND gains.skill_id = cur.skill_id
+            WHERE cur.dtg >= $2::timestamp - $3::interval;"""
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute("""DELETE FROM leaderboard;""")
+                await con.execute(leaderboard_stmt, date.today(), datetime.now(),
+                                  LEADERBOARD_MAX_AGE)
+            await self.load_leaderboards(con)
+
+    async def load_leaderboards(self, con):
+        """Reads the stored leaderboards into memory, keyed by skill id."""
+        board_stmt = """SELECT skill_id, rsn, clan_rank, level, xp, daily_gain, weekly_gain
+            FROM leaderboard ORDER BY skill_id, clan_rank, rsn;"""
+        leaderboards = {}
+        for rec in await con.fetch(board_stmt):
+            leaderboards.setdefault(rec["skill_id"], []).append(rec)
+        self.leaderboards = leaderboards
+
+    @xp.command(name="top")
+    async def top(self, ctx, info: get_skill_info, count: int = TOP_DEFAULT, page: int = 1):
+        """Lists a page of the clan's top players in a skill, count per page, with their daily
+        and weekly gains, e.g. '$xp top agility 10 2' for ranks 11-20."""
+        if info is None:
+            await ctx.send("Please enter a valid skill name.")
+            return
+        if self.leaderboards is None:
+            async with self.bot.pool.acquire() as con:
+                await self.load_leaderboards(con)
+        board = self.leaderboards.get(int(info["id"]), [])
+        if not board:
+            await ctx.send("No leaderboard yet, check back after the next xp update.")
+            return
+        count = max(count, 1)
+        pages = math.ceil(len(board)/count)
+        if not 1 <= page <= pages:
+            await ctx.send(f"Page must be between 1 and {pages}.")
+            return
+        lines = [f"Clan {info['skill'].title()} Leaderboard, page {page} of {pages} "
+                 f"({len(board)} members):"]
+        for rec in board[(page - 1)*count:page*count]:
+            lines.append(f"{rec['clan_rank']}. {rec['rsn']}: level {rec['level']}, "
+                         f"{rec['xp']:,.0f} xp (+{rec['daily_gain']:,.0f} today, "
+                         f"+{rec['weekly_gain']:,.0f} this week)")
+        for out_msg in pack_lines(lines, MAX_MESSAGE_LENGTH - 6):
+            await ctx.send(f"```{out_msg}```")
+
     @xp.command(name="check")
     @commands.is_owner()
     async def check(self, ctx):
         """Rechecks xp and adds new records."""
         await ctx.send("Updating xp records...")
-        await self.report_xp()
-
-    async def report_comp(self, xp_dict):
-        """Adds in comp percentage records from xp records."""
-        comp_counted_xp = 0
-        comp_needed_xp = 0
-        max_counted_xp = 0
-        max_needed_xp = 0
-        skills = xp_dict["skills"]
-        for skill_id, data in skills.items():
-            # Get the max level xp from the database
-            async with self.bot.pool.acquire() as con:
-                comp_level_stmt = '''SELECT max_level FROM level_experience WHERE skill_id = $1'''
-                comp_level = await con.fetchval(comp_level_stmt, skill_id)
-                comp_xp_stmt = '''SELECT (xp_amount ->> $1)::integer as comp_xp FROM level_experience
-                                WHERE skill_id = $2'''
-                max_level = 99
-                max_xp_stmt = '''SELECT (xp_amount ->> $1)::integer as max_xp FROM level_experience
-                                WHERE skill_id = $2'''
-                comp_xp = await con.fetchval(comp_xp_stmt, str(comp_level), skill_id)
-                max_xp = await con.fetchval(max_xp_stmt, str(max_level), skill_id)
-            comp_needed_xp += comp_xp
-            comp_counted_xp += min(comp_xp, data["xp"])
-            max_needed_xp += max_xp
-            max_counted_xp += min(max_xp, data["xp"])
-        comp_pct = comp_counted_xp/(comp_needed_xp*1.0)
-        max_pct = max_counted_xp/(max_needed_xp*1.0)
-        return (max_pct, comp_pct)
-
-    async def report_xp(self):
-        """Adds all xp records to databse."""
-        try:
-            await self.bot.wait_until_ready()
-            while not self.bot.is_closed():
-                logging.info("Updating xp records...")
-                clan_list = await get_clan_list()
-                logging.info(clan_list)
-                logging.info(len(clan_list))
-                async with self.bot.pool.acquire() as con:
-                    await update_names(con, clan_list)
-                for user in clan_list:
-                    logging.info(user)
-                    xp_dict = await check_xp(user)
-                    if xp_dict is not None:
-                        (max_pct, comp_pct) = await self.report_comp(xp_dict)
+        await self.bot.feed.poll(None, [self.report_xp], fresh=True)
+        await self.update_leaderboards()
+
+    async def select_sweep(self, clan_list):
+        """Picks the members to snapshot this tick. The daily sweep is spread evenly over the
+        first SWEEP_WINDOW of each day, skipping members already snapshotted today, so a
+        restart resumes where the sweep stopped."""
+        now = datetime.now()
+        today = now.date()
+        sweep_stmt = """SELECT rsn FROM xp_sweep WHERE day = $1;"""
+        async with self.bot.pool.acquire() as con:
+            swept = {rec["rsn"] for rec in await con.fetch(sweep_stmt, today)}
+        remaining = [user for user in clan_list if user not in swept]
+        elapsed = (now - datetime.combine(today, time()))/SWEEP_WINDOW
+        target = math.ceil(len(clan_list)*min(elapsed, 1))
+        # After downtime, catch up at a few times the steady rate rather than in one burst
+        steady = math.ceil(len(clan_list)*SWEEP_TICK/SWEEP_WINDOW.total_seconds())
+        due = max(target - (len(clan_list) - len(remaining)), 0)
+        batch = remaining[:min(due, SWEEP_CATCHUP*steady)]
+        # Leaderboards are rebuilt once, after the batch that completes the day's sweep
+        self.sweep_finishing = bool(batch) and len(batch) == len(remaining)
+        logging.info(f"XP sweep: {len(clan_list) - len(remaining)} of {len(clan_list)} members "
+                     f"done today, {len(batch)} due now.")
+        return batch
+
+    async def save_sweep(self, con, profiles):
+        """Checkpoints the given members as snapshotted on the day they were fetched."""
+        profiles = list({profile.username: profile for profile in profiles}.values())
+        sweep_stmt = """INSERT INTO xp_sweep(rsn, day, swept_dtg)
+            SELECT * FROM unnest($1::text[], $2::date[], $3::timestamp[])
+            ON CONFLICT (rsn) DO UPDATE SET day = EXCLUDED.day, swept_dtg = EXCLUDED.swept_dtg;"""
+        await con.execute(sweep_stmt, [profile.username for profile in profiles],
+                          [profile.fetched.date() for profile in profiles],
+                          [profile.fetched for profile in profiles])
+
+    async def report_xp(self, profiles):
+        """Adds xp records for the given profiles to the database."""
+        # Sweeps and $xp check both diff against latest_xp, so only one may record at a time
+        async with self.report_lock:
+            try:
+                await self.record_xp(profiles)
+            except Exception as error:
+                # One bad row rolls back the whole batch, so retry members one at a time and
+                # checkpoint any whose own data still fails, letting the sweep move past them.
+                # Any other error leaves the batch unchecked, so it's retried next tick.
+                if not is_row_error(error):
+                    raise
+                logging.exception("Recording xp batch failed, retrying members one at a time.")
+                for profile in profiles:
+                    try:
+                        await self.record_xp([profile])
+                    except Exception as member_error:
+                        if not is_row_error(member_error):
+                            raise
+                        logging.exception(f"Could not record xp for {profile.username}.")
                         async with self.bot.pool.acquire() as con:
-                            await con.set_type_codec(
-                                'json',
-                                encoder=json.dumps,
-                                decoder=json.loads,
-                                schema='pg_catalog'
-                            )
-                            async with con.transaction():
-                                xp_stmt = """INSERT INTO xp(rsn, dtg, skills)
-                                    VALUES($1, $2, $3::json)"""
-                                await con.execute(
-                                    xp_stmt, xp_dict["rsn"], xp_dict["dtg"], xp_dict["skills"])
-                                comp_stmt = """INSERT INTO comp(rsn, dtg, max_pct, comp_pct)
-                                    VALUES($1, $2, $3, $4);"""
-                                await con.execute(
-                                    comp_stmt, xp_dict["rsn"], xp_dict["dtg"], max_pct, comp_pct)
-                    else:
-                        continue
-
-                await asyncio.sleep(86400)
-        except Exception as e:
-            print(e)
+                            await self.save_sweep(con, [profile])
+        if self.sweep_finishing:
+            self.sweep_finishing = False
+            await self.update_leaderboards()
+
+    async def record_xp(self, profiles):
+        """Records snapshots, comp percentages and gains for the given profiles."""
+        logging.info("Updating xp records...")
+        xp_dicts = [xp_dict for xp_dict in map(check_xp, profiles) if xp_dict is not None]
+        # Keep one snapshot per rsn, in case two clan names resolve to the same profile
+        xp_dicts = list({xp_dict["rsn"]: xp_dict for xp_dict in xp_dicts}.values())
+        if not xp_dicts:
+            if profiles:
+                async with self.bot.pool.acquire() as con:
+                    await self.save_sweep(con, profiles)
+            return
+        # Reload while level_experience is still empty, as on a fresh database
+        if self.levels is None or not self.levels.known.any():
+            async with self.bot.pool.acquire() as con:
+                self.levels = await LevelTable.load(con)
+        (max_pcts, comp_pcts) = self.levels.percentages(xp_dicts)
+        rsns = [xp_dict["rsn"] for xp_dict in xp_dicts]
+        dtgs = [xp_dict["dtg"] for xp_dict in xp_dicts]
+        # Snapshots with none of the skills in level_experience have no percentages
+        pct_rows = [row for row in zip(rsns, dtgs, max_pcts.tolist(), comp_pcts.tolist())
+                    if not math.isnan(row[2]) and not math.isnan(row[3])]
+        skill_records = [(xp_dict["rsn"], xp_dict["dtg"], skill_id, data["level"], data["xp"],
+                          data["rank"])
+                         for xp_dict in xp_dicts for skill_id, data in xp_dict["skills"].items()]
+        async with self.bot.pool.acquire() as con:
+            # History and latest tables change together, so readers never see them disagree
+            async with con.transaction():
+                # Profile names can differ from the clan list's, which is all the feed adds
+                await update_names(con, rsns)
+                # History is delta encoded: only skills whose level or xp changed since the
+                # latest snapshot are stored, and unchanged players get no history at all.
+                previous_stmt = """SELECT rsn, skill_id, level, xp FROM latest_xp
+                    WHERE rsn = ANY($1::text[]);"""
+                previous = {(rec["rsn"], rec["skill_id"]): (rec["level"], rec["xp"])
+                            for rec in await con.fetch(previous_stmt, rsns)}
+                changed = [rec for rec in skill_records
+                           if previous.get((rec[0], rec[2]), None) != (rec[3], rec[4])]
+                changed_rsns = {rec[0] for rec in changed}
+                gain_rows = []
+                for rec in changed:
+                    before = previous.get((rec[0], rec[2]), None)
+                    if before is not None and before[1] is not None and rec[4] != before[1]:
+                        gain_rows.append((rec[0], rec[2], rec[1].date(), rec[4] - before[1]))
+                await con.copy_records_to_table(
+                    'xp', records=changed,
+                    columns=['rsn', 'dtg', 'skill_id', 'level', 'xp', 'rank'])
+                comp_rows = [row for row in pct_rows if row[0] in changed_rsns]
+                if comp_rows:
+                    comp_stmt = """INSERT INTO comp(rsn, dtg, max_pct, comp_pct)
+                        SELECT * FROM unnest($1::text[], $2::timestamp[], $3::decimal[],
+                        $4::decimal[]);"""
+                    await con.execute(comp_stmt, *map(list, zip(*comp_rows)))
+                if gain_rows:
+                    gains_stmt = """INSERT INTO xp_gains(rsn, skill_id, day, xp_gained)
+                        SELECT * FROM unnest($1::text[], $2::integer[], $3::date[],
+                        $4::double precision[])
+                        ON CONFLICT (rsn, skill_id, day)
+                        DO UPDATE SET xp_gained = xp_gains.xp_gained + EXCLUDED.xp_gained;"""
+                    await con.execute(gains_stmt, *map(list, zip(*gain_rows)))
+                latest_xp_stmt = """INSERT INTO latest_xp(rsn, dtg, skill_id, level, xp, rank)
+                    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::integer[],
+                    $4::integer[], $5::double precision[], $6::integer[])
+                    ON CONFLICT (rsn, skill_id) DO UPDATE SET dtg = EXCLUDED.dtg,
+                    level = EXCLUDED.level, xp = EXCLUDED.xp, rank = EXCLUDED.rank
+                    WHERE latest_xp.dtg <= EXCLUDED.dtg;"""
+                await con.execute(latest_xp_stmt, *map(list, zip(*skill_records)))
+                latest_comp_stmt = """INSERT INTO latest_comp(rsn, dtg, max_pct, comp_pct)
+                    SELECT * FROM unnest($1::text[], $2::timestamp[], $3::decimal[],
+                    $4::decimal[])
+                    ON CONFLICT (rsn) DO UPDATE SET dtg = EXCLUDED.dtg,
+                    max_pct = EXCLUDED.max_pct, comp_pct = EXCLUDED.comp_pct
+                    WHERE latest_comp.dtg <= EXCLUDED.dtg;"""
+                if pct_rows:
+                    await con.execute(latest_comp_stmt, *map(list, zip(*pct_rows)))
+                # Checkpointed with the snapshots, so each member is stored once per day
+                await self.save_sweep(con, profiles)
+        # Cached charts of these players are now stale
+        if self.change_times is not None:
+            for rsn, dtg in zip(rsns, dtgs):
+                if rsn in changed_rsns:
+                    self.change_times[rsn] = dtg
+        logging.info(f"Recorded xp for {len(xp_dicts)} players, {len(changed_rsns)} changed "
+                     f"({len(changed)} skill rows).")
 
 def setup(bot):
     """Adds the cog to the bot."""
     bot.add_cog(XP(bot))
 
-async def check_xp(username):
-    """Creates a record with the current datetime for user's levels and xp."""
-    url = f"{player_url}{username}&activities=20"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as alog_resp:
-            data_json = await alog_resp.json()
-    name = data_json.get('name', None)
-    skillvalues = data_json.get('skillvalues', None)
+def is_row_error(error):
+    """Checks if a database error comes from one member's data rather than the database as a
+    whole. Inserting past the last partition is reported as a check violation, so it isn't."""
+    return (isinstance(error, (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError))
+            and not isinstance(error, asyncpg.CheckViolationError))
+
+def check_xp(profile):
+    """Creates a record with the fetch datetime for user's levels and xp."""
+    name = profile.name
+    skillvalues = profile.skillvalues
     if name is None or skillvalues is None:
-        logging.info(f"{username}'s profile is private.")
+        logging.info(f"{profile.username}'s profile is private.")
         return None
     xp_dict = {}
     xp_dict["rsn"] = name
-    xp_dict["dtg"] = datetime.now()
+    xp_dict["dtg"] = profile.fetched
     xp_values = {}
     for skillinfo in skillvalues:
         level = skillinfo.get("level", 0)
@@ -6,6 +6,8 @@ import asyncio
 import asyncpg
 from mathbot import MathBot
 from utils import config
+from utils.dbs import init_connection
+from utils.migrations import create_database
 
 @contextlib.contextmanager
 def setup_logging():
@@ -39,9 +41,12 @@ def run_bot(db_reinit):
     try:
         pool = loop.run_until_complete(asyncpg.create_pool(
             database=config.postgre_db, user=config.postgre_user,
-            password=config.postgre_pwd, command_timeout=60, loop=loop))
+            password=config.postgre_pwd, command_timeout=60, init=init_connection,
+            loop=loop))
+        loop.run_until_complete(create_database(db_reinit, pool))
     except Exception:
         log.exception("Could not set up PostgreSQL. Exiting.")
+        return
 
     bot = MathBot()
     bot.pool = pool
@@ -3,6 +3,8 @@ import os
 import logging
 from discord.ext import commands
 from utils import config
+from utils.profiles import ProfileFeed
+from utils.web import WebClient
 
 def extensions_generator():
     """Returns a generator for all cog files that aren't in do_not_use."""
@@ -34,6 +36,8 @@ class MathBot(commands.Bot):
         super().__init__(command_prefix=["$", "!"], description=DESCRIPTION)
         self.token = config.token
         self.default_nick = "MathBot"
+        self.web = WebClient()
+        self.feed = ProfileFeed(self)
         self.add_command(self.load)
 
         for extension in extensions_generator():
@@ -63,6 +67,11 @@ class MathBot(commands.Bot):
             return
         await self.process_commands(message)
 
+    async def close(self):
+        """Closes the shared HTTP client along with the bot."""
+        await self.web.close()
+        await super().close()
+
     def run(self):
         """Runs the bot with the token from the config file."""
         super().run(self.token, reconnect=True)
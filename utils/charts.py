@@ -0,0 +1,129 @@
+"""Renders xp charts in worker processes, returning PNG bytes."""
+import asyncio
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+RENDER_WORKERS = 2
+RENDER_QUEUE_SIZE = 8
+RENDER_TIMEOUT = 30
+CHART_CACHE_BYTES = 32*1024*1024
+HISTORY_POINTS = 400
+# History is bucketed more finely than it is drawn, leaving LTTB room to keep its shape
+HISTORY_BUCKETS = 4*HISTORY_POINTS
+
+class RenderQueueFull(Exception):
+    """Raised when too many charts are already waiting to be rendered."""
+
+def figure_bytes(fig):
+    """Saves a figure to PNG bytes in memory and frees it."""
+    png = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(png, format="png")
+    plt.close(fig)
+    return png.getvalue()
+
+def render_comparison(skill, players, values):
+    """Draws a bar chart comparing players' xp in a skill."""
+    fig, axes = plt.subplots(figsize=(16, 6))
+    axes.set_facecolor("#F3F3F3")
+    index = np.arange(len(players))
+    axes.bar(index, values, alpha=0.4, color="gold", edgecolor="black", align='center')
+    axes.set_xlabel("Players")
+    axes.set_ylabel("XP Amount")
+    axes.set_title(f"Clan {skill.title()} XP Comparison")
+    axes.set_xticks(index)
+    axes.set_xticklabels(players)
+    fig.autofmt_xdate()
+    return figure_bytes(fig)
+
+def lttb(x_values, y_values, threshold):
+    """Picks the indices of at most threshold points that keep a series' visual shape, using
+    Largest-Triangle-Three-Buckets. The first and last points are always kept."""
+    count = len(x_values)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    keep = [0]
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            following = slice(edges[bucket + 1], edges[bucket + 2])
+        else:
+            following = slice(count - 1, count)
+        avg_x = x_values[following].mean()
+        avg_y = y_values[following].mean()
+        prev = keep[-1]
+        areas = np.abs((x_values[prev] - avg_x)*(y_values[start:end] - y_values[prev])
+                       - (x_values[prev] - x_values[start:end])*(avg_y - y_values[prev]))
+        keep.append(int(start) + int(areas.argmax()))
+    keep.append(count - 1)
+    return keep
+
+def render_history(skill, player, dates, values):
+    """Draws a line chart of a player's xp in a skill over time."""
+    fig, axes = plt.subplots()
+    pd.Series(values, index=dates).plot(ax=axes)
+    axes.set_xlabel("Date")
+    axes.set_ylabel("XP Amount")
+    axes.set_title(f"{player}'s {skill.title()} XP Gains")
+    return figure_bytes(fig)
+
+class ChartRenderer:
+    """Runs chart rendering in a process pool, off the event loop."""
+
+    def __init__(self):
+        self.executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+        self.slots = asyncio.Semaphore(RENDER_QUEUE_SIZE)
+
+    async def render(self, func, *args):
+        """Renders a chart with the given function and arguments, returning PNG bytes.
+        Raises RenderQueueFull if the queue is full, or asyncio.TimeoutError if it's too slow."""
+        if self.slots.locked():
+            raise RenderQueueFull()
+        await self.slots.acquire()
+        try:
+            future = asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        # A worker keeps rendering after a timeout, so its slot is only freed once it finishes
+        future.add_done_callback(lambda _: self.slots.release())
+        return await asyncio.wait_for(asyncio.shield(future), RENDER_TIMEOUT)
+
+    def close(self):
+        """Shuts down the worker processes."""
+        self.executor.shutdown(wait=False)
+
+class ChartCache:
+    """Keeps rendered charts and their notices up to a total size, evicting the least recently
+    used."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the cached replies (PNG bytes or notice strings) for a key, or None."""
+        replies = self.entries.get(key, None)
+        if replies is not None:
+            self.entries.move_to_end(key)
+        return replies
+
+    def put(self, key, replies):
+        """Caches the replies for a key, evicting older charts past the size limit."""
+        if key in self.entries:
+            self.size -= sum(map(len, self.entries.pop(key)))
+        self.entries[key] = replies
+        self.size += sum(map(len, replies))
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(map(len, evicted))
@@ -1,29 +1,15 @@
-#!/usr/bin/python3.6
-"""Creates all tables in the database."""
-import asyncio
-import asyncpg
-from utils.config import db_name
-
-async def create_database(reinit, pool=None):
-    """Calls the individual table creation functions."""
-    if pool is not None:
-        conn = await pool.acquire()
-    else:
-        conn = await asyncpg.connect(db_name)
-
-    if reinit:
-        await conn.execute('''
-            DROP TABLE IF EXISTS account cascade;
-            DROP TABLE IF EXISTS rs cascade;
-            DROP TABLE IF EXISTS account_owned;
-            DROP TABLE IF EXISTS caps;
-            DROP TABLE IF EXISTS xp;
-        ''')
-        await create_account_table(conn)
-        await create_rs_table(conn)
-        await create_account_owned_table(conn)
-        await create_caps_table(conn)
-        await create_xp_table(conn)
+"""Defines the table creation and maintenance steps used by the schema migrations."""
+from datetime import date
+import json
+import re
+
+PARTITION_AHEAD_MONTHS = 2
+RETENTION_MONTHS = 6
+ARCHIVE_SCHEMA = None
+
+async def init_connection(conn):
+    """Sets up each new pooled connection, registering the json codec."""
+    await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
 
 async def create_account_table(conn):
     """Creates account table for unique account information."""
@@ -71,41 +57,275 @@ async def create_caps_table(conn):
             last_cap_time timestamp,
             PRIMARY KEY (id),
             FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        );
+        CREATE INDEX IF NOT EXISTS caps_last_cap_time_idx ON caps(last_cap_time);
+    ''')
+
+async def create_cap_reports_table(conn):
+    """Creates cap_reports table, the ledger of caps already announced in the cap channel."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS cap_reports(
+            rsn text NOT NULL,
+            cap_time timestamp NOT NULL,
+            reported_dtg timestamp,
+            PRIMARY KEY (rsn, cap_time),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        )
+    ''')
+
+async def create_alog_marks_table(conn):
+    """Creates alog_marks table, holding the last activity already processed per rsn."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS alog_marks(
+            rsn text NOT NULL,
+            last_activity timestamp NOT NULL,
+            PRIMARY KEY (rsn),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
         )
     ''')
 
 async def create_xp_table(conn):
-    """Creates a table called xp."""
+    """Creates a table called xp, holding one row per skill per snapshot, partitioned by month."""
     await conn.execute('''
         CREATE TABLE IF NOT EXISTS xp(
-            id serial,
             rsn text NOT NULL,
-            dtg timestamp,
-            skills json,
-            PRIMARY KEY(id),
+            dtg timestamp NOT NULL,
+            skill_id integer NOT NULL,
+            level integer,
+            xp double precision,
+            rank integer,
+            PRIMARY KEY (rsn, skill_id, dtg),
             FOREIGN KEY (rsn) REFERENCES rs(rsn)
-        )
+        ) PARTITION BY RANGE (dtg)
+    ''')
+
+async def migrate_xp_json(conn):
+    """Moves snapshots from the old json skills column into the per-skill xp layout."""
+    has_skills = await conn.fetchval('''
+        SELECT EXISTS(SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'xp' AND column_name = 'skills')
     ''')
+    if not has_skills:
+        return
+    async with conn.transaction():
+        await conn.execute('''
+            ALTER TABLE xp RENAME TO xp_json;
+            ALTER TABLE xp_json RENAME CONSTRAINT xp_pkey TO xp_json_pkey;
+            ALTER TABLE xp_json RENAME CONSTRAINT xp_rsn_fkey TO xp_json_rsn_fkey;
+        ''')
+        await create_xp_table(conn)
+        first = await conn.fetchval('''SELECT min(dtg) FROM xp_json''')
+        await ensure_partitions(conn, "xp", first or date.today(), date.today())
+        await conn.execute('''
+            INSERT INTO xp(rsn, dtg, skill_id, level, xp, rank)
+            SELECT rsn, dtg, skill.key::integer, (skill.value ->> 'level')::integer,
+                (skill.value ->> 'xp')::double precision, (skill.value ->> 'rank')::integer
+            FROM xp_json, json_each(skills) AS skill
+            WHERE dtg IS NOT NULL
+            ON CONFLICT DO NOTHING;
+            DROP TABLE xp_json;
+        ''')
 
 async def create_comp_table(conn):
-    """Creates table tracking comp percentages."""
+    """Creates table tracking comp percentages, partitioned by month."""
     await conn.execute('''
         CREATE TABLE IF NOT EXISTS comp(
-            id serial,
             rsn text NOT NULL,
-            dtg timestamp,
+            dtg timestamp NOT NULL,
             max_pct decimal,
             comp_pct decimal,
-            PRIMARY KEY(id),
+            PRIMARY KEY (rsn, dtg),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        ) PARTITION BY RANGE (dtg)
+    ''')
+
+def add_months(day, months):
+    """Returns the first day of the month the given number of months after day's month."""
+    month = day.year*12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+def partition_name(table, month):
+    """Names the partition of table holding the given month."""
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+async def ensure_partitions(conn, table, first, last):
+    """Creates the monthly partitions of table covering every month from first to last."""
+    month = add_months(first, 0)
+    while month <= last:
+        following = add_months(month, 1)
+        await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table}
+            FOR VALUES FROM ('{month}') TO ('{following}')
+        ''')
+        month = following
+
+async def ensure_upcoming_partitions(conn):
+    """Creates the xp and comp partitions for this month and the next few."""
+    today = date.today()
+    for table in ("xp", "comp"):
+        await ensure_partitions(conn, table, today, add_months(today, PARTITION_AHEAD_MONTHS))
+
+async def partition_history(conn, table, create):
+    """Moves an unpartitioned history table into a new monthly partitioned one."""
+    is_heap = await conn.fetchval('''
+        SELECT relkind = 'r' FROM pg_class WHERE oid = to_regclass($1)
+    ''', table)
+    if not is_heap:
+        return
+    async with conn.transaction():
+        await conn.execute(f'''
+            ALTER TABLE {table} RENAME TO {table}_heap;
+            ALTER INDEX {table}_pkey RENAME TO {table}_heap_pkey;
+        ''')
+        await create(conn)
+        first = await conn.fetchval(f'''SELECT min(dtg) FROM {table}_heap''')
+        await ensure_partitions(conn, table, first or date.today(), date.today())
+        # Columns are copied by name; rows without a date can't be placed in a partition
+        columns = ", ".join(
+            rec["column_name"] for rec in await conn.fetch('''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = $1 ORDER BY ordinal_position
+            ''', table))
+        await conn.execute(f'''
+            INSERT INTO {table}({columns}) SELECT {columns} FROM {table}_heap
+            WHERE dtg IS NOT NULL ON CONFLICT DO NOTHING;
+            DROP TABLE {table}_heap;
+        ''')
+
+async def compact_partitions(conn, table, keys, cutoff):
+    """Rewrites the monthly partitions of table ending before cutoff to keep only the last
+    snapshot per week for each keys group. The fine-grained originals are dropped, or moved to
+    ARCHIVE_SCHEMA if it is set."""
+    # Compacted partitions are renamed with a _weekly suffix, so they no longer match
+    pattern = re.compile(rf"{table}_y(\d{{4}})m(\d{{2}})")
+    partitions = await conn.fetch('''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass($1)
+    ''', table)
+    compacted = 0
+    for rec in partitions:
+        match = pattern.fullmatch(rec["relname"])
+        if match is None:
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        following = add_months(month, 1)
+        if following > cutoff:
+            continue
+        fine = rec["relname"]
+        async with conn.transaction():
+            await conn.execute(f'''
+                CREATE TABLE {fine}_weekly (LIKE {fine} INCLUDING DEFAULTS);
+                INSERT INTO {fine}_weekly
+                SELECT DISTINCT ON ({keys}, date_trunc('week', dtg)) * FROM {fine}
+                ORDER BY {keys}, date_trunc('week', dtg), dtg DESC;
+                ALTER TABLE {table} DETACH PARTITION {fine};
+                ALTER TABLE {table} ATTACH PARTITION {fine}_weekly
+                FOR VALUES FROM ('{month}') TO ('{following}');
+            ''')
+            if ARCHIVE_SCHEMA is None:
+                await conn.execute(f'''DROP TABLE {fine}''')
+            else:
+                await conn.execute(f'''
+                    CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA};
+                    ALTER TABLE {fine} SET SCHEMA {ARCHIVE_SCHEMA};
+                ''')
+        compacted += 1
+    return compacted
+
+async def maintain_history(conn):
+    """Adds upcoming partitions and compacts xp and comp history older than RETENTION_MONTHS.
+    Returns the number of partitions compacted."""
+    await ensure_upcoming_partitions(conn)
+    cutoff = add_months(date.today(), -RETENTION_MONTHS)
+    compacted = await compact_partitions(conn, "xp", "rsn, skill_id", cutoff)
+    compacted += await compact_partitions(conn, "comp", "rsn", cutoff)
+    return compacted
+
+async def create_latest_tables(conn):
+    """Creates latest_xp and latest_comp, holding each rsn's most recent snapshot."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS latest_xp(
+            rsn text NOT NULL,
+            skill_id integer NOT NULL,
+            dtg timestamp NOT NULL,
+            level integer,
+            xp double precision,
+            rank integer,
+            PRIMARY KEY (rsn, skill_id),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        );
+        CREATE TABLE IF NOT EXISTS latest_comp(
+            rsn text NOT NULL,
+            dtg timestamp NOT NULL,
+            max_pct decimal,
+            comp_pct decimal,
+            PRIMARY KEY (rsn),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        );
+    ''')
+    # Fill the tables from existing history the first time they are created
+    async with conn.transaction():
+        await conn.execute('''
+            INSERT INTO latest_xp(rsn, skill_id, dtg, level, xp, rank)
+            SELECT DISTINCT ON (rsn, skill_id) rsn, skill_id, dtg, level, xp, rank
+            FROM xp WHERE NOT EXISTS(SELECT 1 FROM latest_xp)
+            ORDER BY rsn, skill_id, dtg DESC;
+            INSERT INTO latest_comp(rsn, dtg, max_pct, comp_pct)
+            SELECT DISTINCT ON (rsn) rsn, dtg, max_pct, comp_pct
+            FROM comp WHERE dtg IS NOT NULL AND NOT EXISTS(SELECT 1 FROM latest_comp)
+            ORDER BY rsn, dtg DESC;
+        ''')
+
+async def create_xp_gains_table(conn):
+    """Creates xp_gains table, rolling up the xp gained per rsn, skill and day."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS xp_gains(
+            rsn text NOT NULL,
+            skill_id integer NOT NULL,
+            day date NOT NULL,
+            xp_gained double precision NOT NULL,
+            PRIMARY KEY (rsn, skill_id, day),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        );
+        CREATE INDEX IF NOT EXISTS xp_gains_skill_day_idx ON xp_gains(skill_id, day);
+    ''')
+    # Fill the rollup from existing history the first time it is created
+    await conn.execute('''
+        INSERT INTO xp_gains(rsn, skill_id, day, xp_gained)
+        SELECT rsn, skill_id, dtg::date, sum(gain) FROM (
+            SELECT rsn, skill_id, dtg,
+                xp - lag(xp) OVER (PARTITION BY rsn, skill_id ORDER BY dtg) AS gain
+            FROM xp) AS deltas
+        WHERE gain IS NOT NULL AND NOT EXISTS(SELECT 1 FROM xp_gains)
+        GROUP BY rsn, skill_id, dtg::date
+        HAVING sum(gain) <> 0;
+    ''')
+
+async def create_xp_sweep_table(conn):
+    """Creates xp_sweep table, checkpointing the day each rsn was last snapshotted."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS xp_sweep(
+            rsn text NOT NULL,
+            day date NOT NULL,
+            swept_dtg timestamp NOT NULL,
+            PRIMARY KEY (rsn),
+            FOREIGN KEY (rsn) REFERENCES rs(rsn)
+        )
+    ''')
+
+async def create_leaderboard_table(conn):
+    """Creates leaderboard table, holding the clan ranking per skill from the last xp cycle."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard(
+            skill_id integer NOT NULL,
+            rsn text NOT NULL,
+            clan_rank integer NOT NULL,
+            level integer,
+            xp double precision,
+            daily_gain double precision,
+            weekly_gain double precision,
+            PRIMARY KEY (skill_id, rsn),
             FOREIGN KEY (rsn) REFERENCES rs(rsn)
         )
     ''')
-#CREATE TABLE level_experience(skill_id integer, name text, max_level integer, is_elite bool, xp_amount json, PRIMARY KEY(skill_id));
-def main():
-    """Runs the database creation."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(create_database(True))
-
-if __name__ == "__main__":
-    main()
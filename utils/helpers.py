@@ -1,9 +1,9 @@
 """Defines helper functions used across classes."""
 from html.parser import HTMLParser
-import async_timeout
-import aiohttp
 from utils.config import clan_url
 
+MAX_MESSAGE_LENGTH = 2000
+
 class MyHTMLParser(HTMLParser):
     """Builds an HTML parser."""
     def handle_data(self, data):
@@ -19,17 +19,10 @@ class MyHTMLParser(HTMLParser):
                 clan_list.append(add_item)
             self.data = clan_list
 
-async def fetch(session, url):
-    """Fetches a web request asynchronously."""
-    async with async_timeout.timeout(10):
-        async with session.get(url) as response:
-            return await response.text()
-
-async def get_clan_list():
+async def get_clan_list(web):
     """Gets the list of clan members."""
     clan_parser = MyHTMLParser()
-    async with aiohttp.ClientSession() as session:
-        req_html = await fetch(session, clan_url)
+    req_html = await web.get_text(clan_url)
     clan_parser.feed(req_html)
     clan_list = clan_parser.data
     return clan_list
@@ -41,3 +34,16 @@ async def update_names(con, clan_list):
         """
         names = [(name,) for name in clan_list]
         await con.executemany(upsert_stmt, names)
+
+def pack_lines(lines, limit=MAX_MESSAGE_LENGTH):
+    """Joins lines into as few newline-separated messages as fit within the length limit."""
+    messages = []
+    current = ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
@@ -0,0 +1,55 @@
+"""Holds the static level_experience table in memory for comp and max calculations."""
+import json
+import numpy as np
+
+MAX_LEVEL = 99
+
+class LevelTable:
+    """Array-backed copy of level_experience, indexed by skill id."""
+
+    def __init__(self, records):
+        size = max([record["skill_id"] for record in records], default=-1) + 1
+        self.known = np.zeros(size, dtype=bool)
+        self.comp_xp = np.zeros(size)
+        self.max_xp = np.zeros(size)
+        for record in records:
+            skill_id = record["skill_id"]
+            xp_amount = record["xp_amount"]
+            if isinstance(xp_amount, str):
+                xp_amount = json.loads(xp_amount)
+            self.known[skill_id] = True
+            self.comp_xp[skill_id] = int(xp_amount[str(record["max_level"])])
+            self.max_xp[skill_id] = int(xp_amount[str(MAX_LEVEL)])
+
+    @classmethod
+    async def load(cls, con):
+        """Reads the whole level_experience table."""
+        level_stmt = """SELECT skill_id, max_level, xp_amount FROM level_experience;"""
+        return cls(await con.fetch(level_stmt))
+
+    def skill_matrix(self, xp_dicts):
+        """Returns (xp, present) arrays of shape players x skills from xp records."""
+        skill_xp = np.zeros((len(xp_dicts), len(self.known)))
+        present = np.zeros(skill_xp.shape, dtype=bool)
+        for row, xp_dict in enumerate(xp_dicts):
+            for skill_id, data in xp_dict["skills"].items():
+                skill_id = int(skill_id)
+                if skill_id < len(self.known) and self.known[skill_id]:
+                    skill_xp[row, skill_id] = data["xp"]
+                    present[row, skill_id] = True
+        return skill_xp, present
+
+    def percentages(self, xp_dicts):
+        """Returns arrays of max and comp percentages, one entry per xp record.
+        Only the skills present in each record count towards its totals, and records with
+        none of the known skills get NaN."""
+        skill_xp, present = self.skill_matrix(xp_dicts)
+        comp_counted = np.where(present, np.minimum(skill_xp, self.comp_xp), 0).sum(axis=1)
+        max_counted = np.where(present, np.minimum(skill_xp, self.max_xp), 0).sum(axis=1)
+        comp_total = present @ self.comp_xp
+        max_total = present @ self.max_xp
+        comp_pct = np.divide(comp_counted, comp_total, out=np.full(len(xp_dicts), np.nan),
+                             where=comp_total > 0)
+        max_pct = np.divide(max_counted, max_total, out=np.full(len(xp_dicts), np.nan),
+                            where=max_total > 0)
+        return max_pct, comp_pct
@@ -0,0 +1,152 @@
+#!/usr/bin/python3.6
+"""Applies numbered schema migrations on startup, recording each in the schema_version table."""
+import asyncio
+import logging
+import asyncpg
+from utils.config import db_name
+from utils.dbs import create_account_table, create_rs_table, create_account_owned_table
+from utils.dbs import create_caps_table, create_cap_reports_table, create_alog_marks_table
+from utils.dbs import create_xp_table, migrate_xp_json, create_comp_table, partition_history
+from utils.dbs import create_latest_tables, create_xp_gains_table, create_leaderboard_table
+from utils.dbs import create_xp_sweep_table, ensure_upcoming_partitions
+
+# Arbitrary key for the advisory lock that keeps two bots from migrating at once
+MIGRATION_LOCK = 4142
+
+async def create_account_tables(conn):
+    """Creates the account, rs and account_owned tables."""
+    await create_account_table(conn)
+    await create_rs_table(conn)
+    await create_account_owned_table(conn)
+
+async def create_cap_tables(conn):
+    """Creates the caps, cap_reports and alog_marks tables."""
+    await create_caps_table(conn)
+    await create_cap_reports_table(conn)
+    await create_alog_marks_table(conn)
+
+async def create_per_skill_xp(conn):
+    """Creates xp with one row per skill, moving snapshots out of the old json column."""
+    await migrate_xp_json(conn)
+    await create_xp_table(conn)
+
+async def partition_xp_and_comp(conn):
+    """Moves xp and comp into tables partitioned by month, creating comp if it is missing."""
+    await partition_history(conn, "xp", create_xp_table)
+    await create_xp_table(conn)
+    await partition_history(conn, "comp", create_comp_table)
+    await create_comp_table(conn)
+    await ensure_upcoming_partitions(conn)
+
+async def create_level_experience_table(conn):
+    """Creates level_experience table, holding the xp needed for each level of each skill."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS level_experience(
+            skill_id integer NOT NULL,
+            name text,
+            max_level integer,
+            is_elite bool,
+            xp_amount json,
+            PRIMARY KEY (skill_id)
+        )
+    ''')
+
+async def add_account_owned_indexes(conn):
+    """Indexes account_owned for lookups by Discord id and by currently owned rsn."""
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS account_owned_disc_id_idx
+            ON account_owned(disc_id, is_main, end_dtg);
+        CREATE INDEX IF NOT EXISTS account_owned_current_rsn_idx
+            ON account_owned(rsn) WHERE end_dtg IS NULL;
+    ''')
+
+async def add_alog_mark_counts(conn):
+    """Counts the activities already processed in each alog mark's own minute."""
+    await conn.execute('''
+        ALTER TABLE alog_marks ADD COLUMN IF NOT EXISTS mark_count integer NOT NULL DEFAULT 0
+    ''')
+
+# Append new migrations here; never renumber or edit one that has been released
+MIGRATIONS = [
+    (1, create_account_tables),
+    (2, create_cap_tables),
+    (3, create_per_skill_xp),
+    (4, partition_xp_and_comp),
+    (5, create_latest_tables),
+    (6, create_xp_gains_table),
+    (7, create_leaderboard_table),
+    (8, create_xp_sweep_table),
+    (9, create_level_experience_table),
+    (10, add_account_owned_indexes),
+    (11, add_alog_mark_counts),
+]
+
+async def apply_migrations(conn):
+    """Runs every migration newer than the recorded schema version, each in its own
+    transaction."""
+    current = await conn.fetchval('''SELECT max(version) FROM schema_version''') or 0
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        async with conn.transaction():
+            await migration(conn)
+            await conn.execute('''
+                INSERT INTO schema_version(version, description) VALUES($1, $2)
+            ''', version, migration.__doc__)
+        logging.info(f"Applied schema migration {version}: {migration.__name__}.")
+
+async def create_database(reinit, pool=None):
+    """Brings the schema up to date, dropping every table first if reinit is set."""
+    if pool is not None:
+        conn = await pool.acquire()
+    else:
+        conn = await asyncpg.connect(db_name)
+
+    try:
+        await conn.execute('''SELECT pg_advisory_lock($1)''', MIGRATION_LOCK)
+        try:
+            if reinit:
+                await conn.execute('''
+                    DROP TABLE IF EXISTS account cascade;
+                    DROP TABLE IF EXISTS rs cascade;
+                    DROP TABLE IF EXISTS account_owned;
+                    DROP TABLE IF EXISTS caps;
+                    DROP TABLE IF EXISTS cap_reports;
+                    DROP TABLE IF EXISTS alog_marks;
+                    DROP TABLE IF EXISTS xp;
+                    DROP TABLE IF EXISTS comp;
+                    DROP TABLE IF EXISTS latest_xp;
+                    DROP TABLE IF EXISTS latest_comp;
+                    DROP TABLE IF EXISTS leaderboard;
+                    DROP TABLE IF EXISTS xp_gains;
+                    DROP TABLE IF EXISTS xp_sweep;
+                    DROP TABLE IF EXISTS schema_version;
+                ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version(
+                    version integer NOT NULL,
+                    description text,
+                    applied_dtg timestamp NOT NULL DEFAULT now(),
+                    PRIMARY KEY (version)
+                )
+            ''')
+            await apply_migrations(conn)
+            # Not a migration: the months ahead move on, so their partitions are checked
+            # on every start as well as by the daily retention job
+            await ensure_upcoming_partitions(conn)
+        finally:
+            await conn.execute('''SELECT pg_advisory_unlock($1)''', MIGRATION_LOCK)
+    finally:
+        if pool is not None:
+            await pool.release(conn)
+        else:
+            await conn.close()
+
+def main():
+    """Runs the database creation."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(create_database(True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Fetches RuneMetrics profiles once per cycle and hands them to every subscribed cog."""
+from collections import OrderedDict
+from datetime import datetime
+import asyncio
+import logging
+import time
+from utils.config import player_url
+from utils.helpers import get_clan_list, update_names
+from utils.web import TokenBucket
+
+FEED_TICK = 60
+POLL_CONCURRENCY = 8
+PLAYER_RATE = 5
+PLAYER_BURST = 10
+PROFILE_TTL = 240
+PROFILE_CACHE_SIZE = 1000
+
+class Profile:
+    """Holds one player's RuneMetrics profile document."""
+
+    def __init__(self, username, data):
+        self.username = username
+        self.name = data.get("name", None)
+        self.activities = data.get("activities", None)
+        self.skillvalues = data.get("skillvalues", None)
+        self.fetched = datetime.now()
+
+class ProfileCache:
+    """Keeps recently fetched profiles for a limited time, evicting the least recently used."""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username):
+        """Returns the cached profile for a player, or None if it is missing or expired."""
+        entry = self.entries.get(username, None)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(username)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, username, profile):
+        """Caches a freshly fetched profile, evicting the oldest entries past the size limit."""
+        self.entries[username] = (time.monotonic(), profile)
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Returns a short summary of cache effectiveness."""
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+class ProfileFeed:
+    """Downloads each member's profile once per cycle and feeds it to all due subscribers."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.subscribers = []
+        self.poll_limit = asyncio.Semaphore(POLL_CONCURRENCY)
+        self.player_bucket = TokenBucket(PLAYER_RATE, PLAYER_BURST)
+        self.cache = ProfileCache(PROFILE_TTL, PROFILE_CACHE_SIZE)
+        self.in_flight = {}
+        self.task = None
+
+    def subscribe(self, callback, interval, select=None):
+        """Registers a coroutine to receive the clan's profiles every interval seconds.
+        If given, select is awaited with the clan list and returns the members to fetch."""
+        self.subscribers.append({"callback": callback, "interval": interval, "select": select,
+                                 "next_run": None})
+        if self.task is None:
+            self.task = self.bot.loop.create_task(self.run())
+
+    async def download_profile(self, username):
+        """Downloads a single player's profile, respecting the concurrency and rate limits."""
+        async with self.poll_limit:
+            await self.player_bucket.acquire()
+            data_json = await self.bot.web.get_json(f"{player_url}{username}&activities=20")
+        profile = Profile(username, data_json)
+        self.cache.put(username, profile)
+        return profile
+
+    async def fetch_profile(self, username, fresh=False):
+        """Returns a single player's profile, from the cache unless fresh is set.
+        Concurrent requests for the same player share a single download."""
+        if not fresh:
+            profile = self.cache.get(username)
+            if profile is not None:
+                return profile
+        task = self.in_flight.get(username, None)
+        if task is None:
+            task = asyncio.ensure_future(self.download_profile(username))
+            self.in_flight[username] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(username, None))
+        # Shielded so that one cancelled waiter doesn't cancel the download for the others
+        return await asyncio.shield(task)
+
+    async def fetch_profiles(self, usernames, fresh=False):
+        """Returns the profiles of all given players concurrently, keeping their order.
+        Players whose download fails are logged and left out."""
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *[self.fetch_profile(user, fresh) for user in usernames], return_exceptions=True)
+        profiles = []
+        for user, result in zip(usernames, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Could not fetch {user}'s profile: {result!r}")
+            else:
+                profiles.append(result)
+        logging.info(f"Fetched {len(profiles)} of {len(usernames)} profiles in "
+                     f"{time.monotonic() - start:.1f}s.")
+        return profiles
+
+    async def dispatch(self, callback, profiles):
+        """Passes profiles to a single consumer, logging rather than raising its errors."""
+        try:
+            await callback(profiles)
+        except Exception:
+            logging.exception(f"Profile consumer {callback.__qualname__} failed.")
+
+    async def poll(self, usernames, callbacks, fresh=False):
+        """Fetches the given players (or the whole clan) once and passes them to each callback.
+        Unlike scheduled cycles, errors from the callbacks propagate to the caller."""
+        if usernames is None:
+            usernames = await get_clan_list(self.bot.web)
+        # Make sure all names are in the database prior to adding new records
+        async with self.bot.pool.acquire() as con:
+            await update_names(con, usernames)
+        profiles = await self.fetch_profiles(usernames, fresh)
+        for callback in callbacks:
+            await callback(profiles)
+        self.log_stats()
+        return profiles
+
+    def log_stats(self):
+        """Logs the HTTP client and profile cache counters."""
+        logging.info(f"HTTP client: {self.bot.web.stats()}")
+        logging.info(f"Profile cache: {self.cache.stats()}")
+
+    async def run_cycle(self, subscribers):
+        """Fetches the union of the members wanted by each subscriber, once each."""
+        clan_list = await get_clan_list(self.bot.web)
+        async with self.bot.pool.acquire() as con:
+            await update_names(con, clan_list)
+        wanted = []
+        for sub in subscribers:
+            if sub["select"] is None:
+                wanted.append(set(clan_list))
+            else:
+                wanted.append(set(await sub["select"](clan_list)))
+        fetch_list = [user for user in clan_list if any(user in users for users in wanted)]
+        profiles = await self.fetch_profiles(fetch_list)
+        for sub, users in zip(subscribers, wanted):
+            await self.dispatch(
+                sub["callback"], [profile for profile in profiles if profile.username in users])
+        self.log_stats()
+
+    async def run(self):
+        """Runs every due subscriber off a single shared download of the clan's profiles."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            now = time.monotonic()
+            due = []
+            for sub in self.subscribers:
+                if sub["next_run"] is None:
+                    sub["next_run"] = now
+                if sub["next_run"] <= now:
+                    due.append(sub)
+                    # Keep each schedule on a fixed grid so that cycles of different
+                    # subscribers line up and share their downloads.
+                    while sub["next_run"] <= now:
+                        sub["next_run"] += sub["interval"]
+            if due:
+                try:
+                    await self.run_cycle(due)
+                except Exception:
+                    logging.exception("Profile feed cycle failed.")
+            await asyncio.sleep(FEED_TICK)
+
+class PollSchedule:
+    """Assigns each player a polling interval based on how recently they were last active."""
+
+    def __init__(self, tiers, dormant_interval, budget):
+        self.tiers = tiers
+        self.dormant_interval = dormant_interval
+        self.budget = budget
+        self.last_polled = {}
+
+    def interval(self, last_activity, utc_now):
+        """Returns the polling interval in seconds for a player last active at last_activity."""
+        if last_activity is None:
+            return self.dormant_interval
+        age = utc_now - last_activity
+        for max_age, interval in self.tiers:
+            if age <= max_age:
+                return interval
+        return self.dormant_interval
+
+    def due(self, usernames, last_activity):
+        """Returns the players due for a poll, most overdue first, within the request budget."""
+        now = time.monotonic()
+        utc_now = datetime.utcnow()
+        waiting = []
+        for user in usernames:
+            interval = self.interval(last_activity.get(user, None), utc_now)
+            polled = self.last_polled.get(user, None)
+            if polled is None:
+                waiting.append((float("inf"), user))
+                continue
+            # Allow one feed tick of slack so a player isn't pushed back a whole
+            # cycle by jitter in when the cycle happens to start.
+            waited = now - polled + FEED_TICK
+            if waited >= interval:
+                waiting.append((waited/interval, user))
+        waiting.sort(key=lambda x: x[0], reverse=True)
+        chosen = {user for _, user in waiting[:self.budget]}
+        logging.info(f"{len(chosen)} of {len(usernames)} members due for polling "
+                     f"({len(waiting)} waiting).")
+        return [user for user in usernames if user in chosen]
+
+    def mark_polled(self, usernames):
+        """Records a successful poll of the given players, restarting their intervals."""
+        now = time.monotonic()
+        for user in usernames:
+            self.last_polled[user] = now
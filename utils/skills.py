@@ -0,0 +1,61 @@
+"""Indexes the skill names and nicknames from the skills file for exact, prefix and fuzzy lookups."""
+from bisect import bisect_left
+from types import MappingProxyType
+import difflib
+import json
+import os
+
+SKILLS_FILE = "./resources/skills.json"
+FUZZY_CUTOFF = 0.75
+
+class SkillIndex:
+    """Read-only lookup of skill info by full name or nickname, ignoring case."""
+
+    def __init__(self, skill_names):
+        self.nicknames = MappingProxyType({
+            nickname: MappingProxyType(dict(info))
+            for nickname, info in skill_names["nicknames"].items()})
+        names = {**skill_names["nicknames"], **skill_names["fullnames"]}
+        self.names = MappingProxyType({
+            name.lower(): MappingProxyType(dict(info)) for name, info in names.items()})
+        self.sorted_names = tuple(sorted(self.names))
+
+    @classmethod
+    def load(cls, path):
+        """Reads and indexes a skills file."""
+        with open(path, "r") as skills_file:
+            return cls(json.load(skills_file))
+
+    def prefixed(self, prefix):
+        """Returns the names starting with prefix."""
+        start = bisect_left(self.sorted_names, prefix)
+        matches = []
+        for name in self.sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
+    def lookup(self, argument):
+        """Returns the info for an exact name, else for a prefix naming only one skill, else for
+        the closest spelling. Returns None if nothing matches."""
+        key = argument.lower()
+        info = self.names.get(key, None)
+        if info is not None:
+            return info
+        prefixed = self.prefixed(key)
+        if prefixed:
+            skills = {self.names[name]["skill"] for name in prefixed}
+            return self.names[prefixed[0]] if len(skills) == 1 else None
+        close = difflib.get_close_matches(key, self.sorted_names, n=1, cutoff=FUZZY_CUTOFF)
+        return self.names[close[0]] if close else None
+
+_loaded = {"mtime": None, "index": None}
+
+def get_skill_index():
+    """Returns the skill index, rebuilding it only when the skills file has changed."""
+    mtime = os.stat(SKILLS_FILE).st_mtime_ns
+    if mtime != _loaded["mtime"]:
+        _loaded["index"] = SkillIndex.load(SKILLS_FILE)
+        _loaded["mtime"] = mtime
+    return _loaded["index"]
@@ -0,0 +1,85 @@
+"""Provides the pooled HTTP client shared by the bot and all cogs."""
+import asyncio
+import aiohttp
+
+MAX_CONNECTIONS = 20
+MAX_CONNECTIONS_PER_HOST = 10
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+TOTAL_TIMEOUT = 30
+
+class WebClient:
+    """Wraps a single keep-alive aiohttp session for the lifetime of the bot."""
+
+    def __init__(self):
+        self.session = None
+        self.new_connections = 0
+        self.reused_connections = 0
+
+    async def on_connection_create(self, session, trace_ctx, params):
+        """Counts connections opened by the pool."""
+        self.new_connections += 1
+
+    async def on_connection_reuse(self, session, trace_ctx, params):
+        """Counts requests served over an already open connection."""
+        self.reused_connections += 1
+
+    def get_session(self):
+        """Returns the shared session, creating it on first use."""
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self.on_connection_create)
+            trace_config.on_connection_reuseconn.append(self.on_connection_reuse)
+            connector = aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, connect=CONNECT_TIMEOUT)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout,
+                headers={"Accept-Encoding": "gzip, deflate"}, trace_configs=[trace_config])
+        return self.session
+
+    async def get_text(self, url):
+        """Fetches a web request and returns the body as text."""
+        async with self.get_session().get(url) as response:
+            return await response.text()
+
+    async def get_json(self, url):
+        """Fetches a web request and returns the decoded json body."""
+        async with self.get_session().get(url) as response:
+            return await response.json()
+
+    def stats(self):
+        """Returns a short summary of connection reuse."""
+        return (f"{self.new_connections} new connections, "
+                f"{self.reused_connections} reused connections")
+
+    async def close(self):
+        """Closes the shared session and its connection pool."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+class TokenBucket:
+    """Limits requests to a steady rate while allowing short bursts."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a token is available, then consumes it."""
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens)/self.rate)